@@ -4,11 +4,15 @@ import hashlib
 import base64
 import json
 import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Conditionally import boto3
 try:
     import boto3
+    from botocore.config import Config
     from botocore.exceptions import ClientError
     boto3_available = True
 except ImportError:
@@ -24,11 +28,24 @@ COGNITO_USER_POOL_ID = os.environ.get('COGNITO_USER_POOL_ID', '')
 COGNITO_APP_CLIENT_ID = os.environ.get('COGNITO_APP_CLIENT_ID', '')
 COGNITO_APP_CLIENT_SECRET = os.environ.get('COGNITO_APP_CLIENT_SECRET', '')
 
+# verify_token results are cached briefly so repeated checks of the same
+# token don't each round-trip to Cognito. Failures are cached for less time.
+TOKEN_CACHE_MAXSIZE = 10000
+TOKEN_CACHE_TTL = 5  # seconds
+TOKEN_CACHE_NEGATIVE_TTL = 1  # seconds
+
 # Initialize the Cognito Identity Provider client
 cognito_client = None
 if boto3_available:
     try:
-        cognito_client = boto3.client('cognito-idp', region_name=AWS_REGION)
+        # Larger connection pool so concurrent handlers reuse TLS connections
+        # instead of queueing on the default pool of 10
+        cognito_config = Config(
+            region_name=AWS_REGION,
+            max_pool_connections=50,
+            retries={'mode': 'standard', 'max_attempts': 3}
+        )
+        cognito_client = boto3.client('cognito-idp', config=cognito_config)
     except Exception as e:
         print(f"Warning: Could not initialize Cognito client: {str(e)}")
         cognito_client = None
@@ -37,18 +54,53 @@ def local_auth_enabled():
     """Check if local authentication should be used"""
     return not cognito_client or not COGNITO_USER_POOL_ID or not COGNITO_APP_CLIENT_ID
 
+@lru_cache(maxsize=4096)
+def _secret_hash_cached(username, client_id, client_secret):
+    """Compute the Cognito secret hash; cached since it is fixed per user and app client"""
+    message = username + client_id
+    # One-shot C HMAC (OpenSSL) instead of building an hmac object
+    dig = hmac.digest(client_secret.encode('utf-8'), message.encode('utf-8'), 'sha256')
+    return base64.b64encode(dig).decode()
+
 def get_secret_hash(username):
     """Generate a secret hash for the Cognito API"""
     if not COGNITO_APP_CLIENT_SECRET:
         return None
         
-    message = username + COGNITO_APP_CLIENT_ID
-    dig = hmac.new(
-        COGNITO_APP_CLIENT_SECRET.encode('utf-8'),
-        msg=message.encode('utf-8'),
-        digestmod=hashlib.sha256
-    ).digest()
-    return base64.b64encode(dig).decode()
+    return _secret_hash_cached(username, COGNITO_APP_CLIENT_ID, COGNITO_APP_CLIENT_SECRET)
+
+@lru_cache(maxsize=4)
+def _hmac_pad_states(client_secret):
+    """Precompute the inner/outer SHA-256 states of an HMAC keyed with client_secret"""
+    key = client_secret.encode('utf-8')
+    block_size = hashlib.sha256().block_size
+    if len(key) > block_size:
+        key = hashlib.sha256(key).digest()
+    key = key.ljust(block_size, b'\0')
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    outer = hashlib.sha256(bytes(b ^ 0x5c for b in key))
+    return inner, outer
+
+def get_secret_hashes(usernames):
+    """Generate Cognito secret hashes for many users at once
+    
+    The key-dependent half of the HMAC is hashed once and cloned per user,
+    which is cheaper than a full HMAC per call when sweeping many accounts.
+    Returns a list in the same order as usernames (None if no secret is configured).
+    """
+    if not COGNITO_APP_CLIENT_SECRET:
+        return [None for _ in usernames]
+    
+    inner, outer = _hmac_pad_states(COGNITO_APP_CLIENT_SECRET)
+    client_id = COGNITO_APP_CLIENT_ID.encode('utf-8')
+    hashes = []
+    for username in usernames:
+        inner_hash = inner.copy()
+        inner_hash.update(username.encode('utf-8') + client_id)
+        outer_hash = outer.copy()
+        outer_hash.update(inner_hash.digest())
+        hashes.append(base64.b64encode(outer_hash.digest()).decode())
+    return hashes
 
 def sign_up(username, password, email):
     """Register a new user with Cognito"""
@@ -168,6 +220,31 @@ def sign_in(username, password):
             "message": str(e)
         }
 
+# Bounded LRU of sha256(token) -> (expiry, result), guarded for Gradio's worker threads
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+def _get_cached_token_result(key):
+    """Return a cached verify_token result, or None if missing or expired"""
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at <= time.monotonic():
+            del _token_cache[key]
+            return None
+        _token_cache.move_to_end(key)
+        return dict(result)
+
+def _cache_token_result(key, result, ttl):
+    """Store a verify_token result, evicting the least recently used entries"""
+    with _token_cache_lock:
+        _token_cache[key] = (time.monotonic() + ttl, dict(result))
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_MAXSIZE:
+            _token_cache.popitem(last=False)
+
 def verify_token(token):
     """Verify a JWT token from Cognito"""
     if local_auth_enabled():
@@ -177,6 +254,12 @@ def verify_token(token):
         # In a real implementation, we would extract the username from the token
         return {"success": True, "username": "local_user"}
     
+    # Key on a digest so raw tokens are never kept in memory
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    cached = _get_cached_token_result(key)
+    if cached is not None:
+        return cached
+    
     try:
         response = cognito_client.get_user(
             AccessToken=token
@@ -185,15 +268,19 @@ def verify_token(token):
         # Extract username from response
         username = response['Username']
         
-        return {
+        result = {
             "success": True,
             "username": username
         }
+        _cache_token_result(key, result, TOKEN_CACHE_TTL)
+        return result
     except ClientError as e:
-        return {
+        result = {
             "success": False,
             "message": str(e)
         }
+        _cache_token_result(key, result, TOKEN_CACHE_NEGATIVE_TTL)
+        return result
 
 # For local development without AWS
 def local_auth_enabled():
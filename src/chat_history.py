@@ -1,12 +1,34 @@
 from datetime import datetime
 from database import (
     save_chat_message as db_save_chat_message,
+    save_chat_messages_bulk as db_save_chat_messages_bulk,
     get_chat_history as db_get_chat_history,
     save_document_record as db_save_document_record,
+    bulk_insert_documents as db_bulk_insert_documents,
     get_user_documents as db_get_user_documents,
-    db_manager
+    get_db_manager
 )
 
+# Optional C ISO 8601 parser; falls back to datetime.fromisoformat
+try:
+    from ciso8601 import parse_datetime
+except ImportError:
+    parse_datetime = None
+
+def _parse_timestamp(timestamp):
+    """Convert an ISO format timestamp string to datetime, or None if it can't be parsed"""
+    if timestamp and isinstance(timestamp, str):
+        try:
+            if parse_datetime is not None:
+                return parse_datetime(timestamp)
+            # Only rewrite a trailing 'Z' (older fromisoformat doesn't accept it)
+            if timestamp.endswith('Z'):
+                timestamp = timestamp[:-1] + '+00:00'
+            return datetime.fromisoformat(timestamp)
+        except ValueError:
+            return None
+    return timestamp
+
 def save_chat_message(user_id, message_type, content, timestamp=None):
     """Save a chat message to the database
     
@@ -16,27 +38,44 @@ def save_chat_message(user_id, message_type, content, timestamp=None):
         content (str): The message content
         timestamp (str, optional): ISO format timestamp. If None, current time is used.
     """
-    # Convert string timestamp to datetime if provided
-    if timestamp and isinstance(timestamp, str):
-        try:
-            timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-        except ValueError:
-            # If parsing fails, use current time
-            timestamp = None
+    # Convert string timestamp to datetime if provided (None means current time)
+    timestamp = _parse_timestamp(timestamp)
     
     return db_save_chat_message(user_id, message_type, content, timestamp)
 
-def get_chat_history(user_id, limit=50):
+def save_chat_messages(user_id, messages):
+    """Save several chat messages for a user in one database round trip
+    
+    Args:
+        user_id (str): The user ID
+        messages (list): Dictionaries with 'role' ('user' or 'assistant'), 'content'
+            and optionally 'timestamp' (ISO format string)
+    """
+    return db_save_chat_messages_bulk([
+        {
+            'user_id': user_id,
+            'message_type': message['role'],
+            'content': message['content'],
+            'timestamp': _parse_timestamp(message.get('timestamp'))
+        }
+        for message in messages
+    ])
+
+def get_chat_history(user_id, limit=50, before=None, before_id=None):
     """Get chat history for a specific user
     
     Args:
         user_id (str): The user ID
         limit (int, optional): Maximum number of messages to retrieve
+        before (str, optional): ISO format timestamp; only return messages older than this.
+            Use the oldest timestamp of the current page to fetch the previous one.
+        before_id (int, optional): Id of the oldest message of the current page; pass it
+            with `before` so messages sharing that timestamp aren't skipped
         
     Returns:
-        list: List of chat messages
+        list: List of chat messages, oldest first
     """
-    return db_get_chat_history(user_id, limit)
+    return db_get_chat_history(user_id, limit, _parse_timestamp(before), before_id)
 
 def save_document_record(user_id, doc_id, filename):
     """Save a record of an uploaded document
@@ -48,6 +87,18 @@ def save_document_record(user_id, doc_id, filename):
     """
     return db_save_document_record(user_id, doc_id, filename)
 
+def save_document_records(user_id, documents):
+    """Save records for several uploaded documents in one database call
+    
+    Args:
+        user_id (str): The user ID
+        documents (list): Dictionaries with 'doc_id' and 'filename'
+    """
+    return db_bulk_insert_documents([
+        {'user_id': user_id, 'doc_id': doc['doc_id'], 'filename': doc['filename']}
+        for doc in documents
+    ])
+
 def get_user_documents(user_id):
     """Get all documents uploaded by a specific user
     
@@ -61,4 +112,4 @@ def get_user_documents(user_id):
 
 def test_database_connection():
     """Test the database connection"""
-    return db_manager.test_connection()
+    return get_db_manager().test_connection()
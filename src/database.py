@@ -1,11 +1,15 @@
 import os
+import csv
+import io
 from datetime import datetime
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Index, text
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Index, text, insert, select, tuple_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import NullPool
 from sqlalchemy.exc import SQLAlchemyError
 import logging
+import threading
 
 # Load environment variables
 load_dotenv()
@@ -36,7 +40,8 @@ class ChatMessage(Base):
     
     # Add index for efficient queries
     __table_args__ = (
-        Index('idx_user_timestamp', 'user_id', 'timestamp'),
+        # id breaks ties between messages saved with the same timestamp (see get_chat_history)
+        Index('idx_user_timestamp', 'user_id', 'timestamp', 'id'),
     )
 
 class UserDocument(Base):
@@ -54,6 +59,10 @@ class UserDocument(Base):
         Index('idx_doc_id', 'doc_id'),
     )
 
+# Chat inserts are built once so every call reuses the same statement and its
+# entry in the engine's compiled cache
+_insert_chat_message = insert(ChatMessage)
+
 class DatabaseManager:
     def __init__(self):
         self.engine = None
@@ -89,6 +98,17 @@ class DatabaseManager:
                 logger.error(f"Failed to initialize SQLite fallback: {str(sqlite_error)}")
                 raise Exception(f"Both PostgreSQL and SQLite initialization failed. PostgreSQL: {str(e)}, SQLite: {str(sqlite_error)}")
     
+    def _pool_kwargs(self, pooled_defaults):
+        """Engine pool settings, chosen from the environment at initialization time
+        
+        DB_SHORT_LIVED=1 (one-off scripts) disables pooling so nothing is left to tear
+        down at exit; otherwise pooled_defaults are used, with a LIFO pool that keeps
+        the most recently used connections warm.
+        """
+        if os.getenv('DB_SHORT_LIVED', '') == '1':
+            return {'poolclass': NullPool}
+        return pooled_defaults
+    
     def _setup_postgresql(self):
         """Setup PostgreSQL connection"""
         if not all([DB_HOST, DB_NAME, DB_USER, DB_PASSWORD]):
@@ -114,10 +134,14 @@ class DatabaseManager:
         try:
             self.engine = create_engine(
                 connection_string,
-                pool_size=5,  # Reduced pool size for compatibility
-                max_overflow=10,
+                **self._pool_kwargs({
+                    'pool_size': int(os.getenv('DB_POOL_SIZE', '20')),
+                    'max_overflow': 20,
+                    'pool_use_lifo': True
+                }),
                 pool_pre_ping=True,
                 pool_recycle=3600,  # Recycle connections every hour
+                executemany_mode='values_plus_batch',  # Batch executemany statements into paged round trips
                 echo=False,
                 connect_args={
                     "connect_timeout": 30,
@@ -145,6 +169,7 @@ class DatabaseManager:
         
         self.engine = create_engine(
             connection_string,
+            **self._pool_kwargs({}),
             pool_pre_ping=True,
             echo=False
         )
@@ -162,19 +187,46 @@ class DatabaseManager:
     def test_connection(self) -> bool:
         """Test database connection"""
         try:
-            with self.get_session() as session:
-                session.execute("SELECT 1")
+            # A pooled connection is enough for a probe; no ORM session needed
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1")).scalar()
                 return True
         except Exception as e:
             logger.error(f"Database connection test failed: {str(e)}")
             return False
+    
+    def ping(self) -> bool:
+        """Cheap health check that avoids a query while the pool holds idle connections
+        
+        Idle pooled connections are validated by pool_pre_ping on their next checkout,
+        so a query is only issued when the pool has nothing checked in.
+        """
+        if self.engine is None:
+            return False
+        
+        checkedin = getattr(self.engine.pool, 'checkedin', None)
+        if checkedin is not None and checkedin() > 0:
+            return True
+        
+        return self.test_connection()
 
-# Global database manager instance
-db_manager = DatabaseManager()
+# Global database manager instance, created on first use so importing this
+# module doesn't connect to the database or run create_all
+_db_manager = None
+_db_manager_lock = threading.Lock()
+
+def get_db_manager() -> DatabaseManager:
+    """Get the shared database manager, initializing it on first call"""
+    global _db_manager
+    if _db_manager is None:
+        with _db_manager_lock:
+            if _db_manager is None:
+                _db_manager = DatabaseManager()
+    return _db_manager
 
 def get_db_session():
     """Get a database session - use this function throughout the application"""
-    return db_manager.get_session()
+    return get_db_manager().get_session()
 
 def save_chat_message(user_id: str, message_type: str, content: str, timestamp: datetime = None):
     """Save a chat message to the database
@@ -190,49 +242,97 @@ def save_chat_message(user_id: str, message_type: str, content: str, timestamp:
     
     try:
         with get_db_session() as session:
-            message = ChatMessage(
-                user_id=user_id,
-                message_type=message_type,
-                content=content,
-                timestamp=timestamp
-            )
-            session.add(message)
+            session.execute(_insert_chat_message, {
+                'user_id': user_id,
+                'message_type': message_type,
+                'content': content,
+                'timestamp': timestamp
+            })
             session.commit()
             logger.debug(f"Saved chat message for user {user_id}")
     except SQLAlchemyError as e:
         logger.error(f"Error saving chat message: {str(e)}")
         raise Exception(f"Failed to save chat message: {str(e)}")
 
-def get_chat_history(user_id: str, limit: int = 50):
+def save_chat_messages_bulk(items):
+    """Save several chat messages with a single multi-row INSERT
+    
+    Args:
+        items (list): Dictionaries with 'user_id', 'message_type', 'content'
+            and optionally 'timestamp' (datetime). Missing timestamps use the current time.
+    """
+    if not items:
+        return
+    
+    now = datetime.utcnow()
+    rows = [
+        {
+            'user_id': item['user_id'],
+            'message_type': item['message_type'],
+            'content': item['content'],
+            'timestamp': item.get('timestamp') or now
+        }
+        for item in items
+    ]
+    
+    try:
+        with get_db_session() as session:
+            session.execute(_insert_chat_message, rows)
+            session.commit()
+            logger.debug(f"Saved {len(rows)} chat messages")
+    except SQLAlchemyError as e:
+        logger.error(f"Error saving chat messages: {str(e)}")
+        raise Exception(f"Failed to save chat messages: {str(e)}")
+
+def get_chat_history(user_id: str, limit: int = 50, before: datetime = None, before_id: int = None):
     """Get chat history for a specific user
     
+    Returns the most recent `limit` messages, oldest first. Pass the timestamp and id
+    of the oldest message already shown as `before` and `before_id` to fetch the
+    previous page.
+    
     Args:
         user_id (str): The user ID
         limit (int, optional): Maximum number of messages to retrieve
+        before (datetime, optional): Only return messages older than this (keyset cursor)
+        before_id (int, optional): Id of the message at `before`. Messages saved together
+            share a timestamp, so without it a page ending between them skips the rest
         
     Returns:
         list: List of chat messages as dictionaries
     """
     try:
+        # Select plain columns so rows skip ORM identity-map bookkeeping
+        stmt = select(
+            ChatMessage.id,
+            ChatMessage.user_id,
+            ChatMessage.message_type,
+            ChatMessage.content,
+            ChatMessage.timestamp
+        ).where(ChatMessage.user_id == user_id)
+        
+        # Keyset pagination: walk idx_user_timestamp backwards from the cursor
+        # instead of scanning and discarding OFFSET rows
+        if before is not None and before_id is not None:
+            stmt = stmt.where(tuple_(ChatMessage.timestamp, ChatMessage.id) < tuple_(before, before_id))
+        elif before is not None:
+            stmt = stmt.where(ChatMessage.timestamp < before)
+        stmt = stmt.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(limit)
+        
         with get_db_session() as session:
-            messages = session.query(ChatMessage)\
-                .filter(ChatMessage.user_id == user_id)\
-                .order_by(ChatMessage.timestamp.asc())\
-                .limit(limit)\
-                .all()
-            
-            # Convert to list of dictionaries for compatibility
-            result = []
-            for msg in messages:
-                result.append({
-                    'id': msg.id,
-                    'user_id': msg.user_id,
-                    'role': msg.message_type,  # Keep 'role' for compatibility
-                    'content': msg.content,
-                    'timestamp': msg.timestamp.isoformat()
-                })
-            
-            return result
+            rows = session.execute(stmt).mappings().all()
+        
+        # Convert to list of dictionaries for compatibility, oldest first
+        return [
+            {
+                'id': row['id'],
+                'user_id': row['user_id'],
+                'role': row['message_type'],  # Keep 'role' for compatibility
+                'content': row['content'],
+                'timestamp': row['timestamp'].isoformat()
+            }
+            for row in reversed(rows)
+        ]
     except SQLAlchemyError as e:
         logger.error(f"Error retrieving chat history: {str(e)}")
         return []
@@ -260,6 +360,69 @@ def save_document_record(user_id: str, doc_id: str, filename: str):
         logger.error(f"Error saving document record: {str(e)}")
         raise Exception(f"Failed to save document record: {str(e)}")
 
+def _copy_document_rows(engine, rows):
+    """Stream document rows into PostgreSQL with COPY ... FROM STDIN"""
+    buf = io.StringIO()
+    # Quote every field so empty strings aren't read back as NULL
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL)
+    for row in rows:
+        writer.writerow([row['user_id'], row['doc_id'], row['filename'], row['upload_timestamp'].isoformat()])
+    buf.seek(0)
+    
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.copy_expert(
+            f"COPY {UserDocument.__tablename__} (user_id, doc_id, filename, upload_timestamp) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buf
+        )
+        cursor.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+def bulk_insert_documents(records):
+    """Save many document records at once
+    
+    Uses COPY on PostgreSQL, which skips per-row parsing and planning, and a
+    single multi-row INSERT on other databases.
+    
+    Args:
+        records (list): Dictionaries with 'user_id', 'doc_id', 'filename' and optionally
+            'upload_timestamp' (datetime). Missing timestamps use the current time.
+    """
+    if not records:
+        return
+    
+    now = datetime.utcnow()
+    rows = [
+        {
+            'user_id': record['user_id'],
+            'doc_id': record['doc_id'],
+            'filename': record['filename'],
+            'upload_timestamp': record.get('upload_timestamp') or now
+        }
+        for record in records
+    ]
+    
+    engine = get_db_manager().engine
+    try:
+        if engine.dialect.name == 'postgresql':
+            _copy_document_rows(engine, rows)
+        else:
+            with get_db_session() as session:
+                session.execute(insert(UserDocument), rows)
+                session.commit()
+        logger.debug(f"Saved {len(rows)} document records")
+    except Exception as e:
+        # COPY goes through the raw DBAPI connection, so errors aren't always SQLAlchemyError
+        logger.error(f"Error saving document records: {str(e)}")
+        raise Exception(f"Failed to save document records: {str(e)}")
+
 def get_user_documents(user_id: str):
     """Get all documents uploaded by a specific user
     
@@ -270,32 +433,40 @@ def get_user_documents(user_id: str):
         list: List of document records as dictionaries
     """
     try:
+        stmt = select(
+            UserDocument.id,
+            UserDocument.user_id,
+            UserDocument.doc_id,
+            UserDocument.filename,
+            UserDocument.upload_timestamp
+        ).where(UserDocument.user_id == user_id)\
+            .order_by(UserDocument.upload_timestamp.desc())
+        
         with get_db_session() as session:
-            documents = session.query(UserDocument)\
-                .filter(UserDocument.user_id == user_id)\
-                .order_by(UserDocument.upload_timestamp.desc())\
-                .all()
-            
-            # Convert to list of dictionaries for compatibility
-            result = []
-            for doc in documents:
-                result.append({
-                    'id': doc.id,
-                    'user_id': doc.user_id,
-                    'doc_id': doc.doc_id,
-                    'filename': doc.filename,
-                    'upload_timestamp': doc.upload_timestamp.isoformat()
-                })
-            
-            return result
+            rows = session.execute(stmt).mappings().all()
+        
+        # Convert to list of dictionaries for compatibility
+        return [
+            {
+                'id': row['id'],
+                'user_id': row['user_id'],
+                'doc_id': row['doc_id'],
+                'filename': row['filename'],
+                'upload_timestamp': row['upload_timestamp'].isoformat()
+            }
+            for row in rows
+        ]
     except SQLAlchemyError as e:
         logger.error(f"Error retrieving user documents: {str(e)}")
         return []
 
 # Initialize database on import
 if __name__ == "__main__":
+    # One-off check: don't keep a connection pool around
+    os.environ.setdefault('DB_SHORT_LIVED', '1')
+    
     # Test the database connection
-    if db_manager.test_connection():
+    if get_db_manager().test_connection():
         print("Database connection successful!")
     else:
         print("Database connection failed!")
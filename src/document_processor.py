@@ -2,38 +2,134 @@ import pytesseract
 from PIL import Image
 import fitz  # PyMuPDF for PDF processing
 import os
-import tempfile
 from pathlib import Path
 import json
+import logging
+import time
 import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from contextlib import nullcontext
+import numpy as np
+import httpx
+from grpc import RpcError, StatusCode
 from fastembed import TextEmbedding
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.models import (
+    VectorParams, Distance, OptimizersConfigDiff, PayloadSchemaType,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType
+)
 
-# Initialize Qdrant client
-client = QdrantClient(host="localhost", port=6333)
-embedding_model = TextEmbedding()
+# tesserocr calls Tesseract through its C API; fall back to the pytesseract CLI wrapper
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
+# Ingestion progress is logged at DEBUG; the app's logging config decides whether it shows
+logger = logging.getLogger(__name__)
+
+# Embedding model shared by ingestion and the chat app. fastembed serves this name as
+# Qdrant's INT8-quantized ONNX export of BGE-small, so no separate quantization step is needed
+EMBED_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+
+# ONNX Runtime threads per embedding session. Left unset, ORT sizes its pool from the
+# host's core count, which containers often misreport; count the cores this process may
+# actually run on, and cap it so concurrent uploads and chat turns don't oversubscribe them
+EMBED_THREADS = min(4, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+
+# Qdrant connection settings, shared by every client in the process. gRPC ships vectors
+# as packed floats, not JSON, and multiplexes concurrent calls over one channel; the few
+# calls that go over REST reuse pooled keep-alive connections instead of re-handshaking
+QDRANT_CLIENT_KWARGS = {
+    "host": "localhost",
+    "grpc_port": 6334,
+    "prefer_grpc": True,
+    "timeout": 30,
+    "limits": httpx.Limits(max_connections=100, max_keepalive_connections=50)
+}
+
+# Initialize the process-wide Qdrant client
+client = QdrantClient(**QDRANT_CLIENT_KWARGS)
+
+# The embedding model is loaded on first use (see get_embedding_model), so importing this
+# module doesn't hold up the app's startup
+embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+# Fork PDF workers where the platform allows it: children inherit the loaded modules and
+# Qdrant client copy-on-write instead of re-importing this module and setting them up again.
+# Forks only happen under _fitz_lock (see process_pdf), so no child starts mid-MuPDF call
+_mp_context = (
+    multiprocessing.get_context("fork")
+    if "fork" in multiprocessing.get_all_start_methods() else None
+)
 
 # Constants
 VECTOR_SIZE = 384  # FastEmbed default
+EMBED_BATCH_SIZE = 64  # Chunks per ONNX forward pass
+UPLOAD_BATCH_SIZE = 64  # Points per upload request
+PDF_PARALLEL_MIN_PAGES = 16  # Below this, reopening the PDF per worker costs more than it saves
+PDF_MAX_WORKERS = 4  # MuPDF text extraction stops scaling beyond ~4-6 processes
+INDEXING_THRESHOLD = 20000  # Qdrant's default; restored once a bulk upload finishes
 
 def chunk_text(text, chunk_size=1000, overlap=200):
     """Split text into overlapping chunks"""
-    chunks = []
-    start = 0
-    text_length = len(text)
-    
-    while start < text_length:
-        end = min(start + chunk_size, text_length)
-        chunk = text[start:end]
-        chunks.append(chunk)
-        
-        if end == text_length:
-            break
-            
-        start += chunk_size - overlap
-        
-    return chunks
+    if not text:
+        return []
+    # A window starts every (chunk_size - overlap) characters; stopping `overlap` short
+    # of the end drops the last window, whose text would be entirely covered by the one before it
+    starts = range(0, max(len(text) - overlap, 1), chunk_size - overlap)
+    return [text[start:start + chunk_size] for start in starts]
+
+_tess_local = threading.local()
+
+def ocr_image(img):
+    """Run OCR on a PIL image, reusing one initialized Tesseract engine per thread"""
+    if PyTessBaseAPI is None:
+        return pytesseract.image_to_string(img)
+    # PyTessBaseAPI is not thread-safe, so each handler thread keeps its own
+    api = getattr(_tess_local, "api", None)
+    if api is None:
+        api = _tess_local.api = PyTessBaseAPI()
+    api.SetImage(img)
+    return api.GetUTF8Text()
+
+def downscale_for_ocr(img, target_dpi=300):
+    """Shrink an image scanned above target_dpi in place; OCR accuracy plateaus around 300 DPI"""
+    dpi = img.info.get("dpi", (target_dpi, target_dpi))
+    source_dpi = max(float(dpi[0]), float(dpi[1]))
+    if source_dpi > target_dpi:
+        scale = target_dpi / source_dpi
+        img.thumbnail((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    return img
+
+# PyMuPDF is not thread-safe and uploads are parsed on several threads, so in-process MuPDF
+# calls are serialized. Forked page workers never take it: a child could inherit it held.
+_fitz_lock = threading.RLock()
+
+def _page_text(page, lock=nullcontext()):
+    """Text of a PDF page, OCR'ing a 300 DPI render when the page has no text layer"""
+    with lock:
+        text = page.get_text()
+        if text.strip():
+            return text
+        pix = page.get_pixmap(dpi=300)
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    # OCR runs outside the lock so other threads can keep parsing
+    return ocr_image(img)
+
+def _extract_page(path, page_num):
+    """Extract the text of one PDF page; runs in a worker process"""
+    try:
+        with fitz.open(path) as pdf_document:
+            return _page_text(pdf_document[page_num])
+    except Exception as page_error:
+        print(f"Error extracting text from page {page_num+1}: {str(page_error)}")
+        return ""
 
 def process_image(file_path, filename, doc_id, user_id):
     """Process an image file with OCR"""
@@ -57,7 +153,7 @@ def process_image(file_path, filename, doc_id, user_id):
             raise Exception(f"Failed to open image: {str(img_error)}")
         
         # Extract text using OCR
-        text = pytesseract.image_to_string(img)
+        text = ocr_image(downscale_for_ocr(img))
         
         # Check if OCR extracted any text
         if not text.strip():
@@ -77,9 +173,6 @@ def process_image(file_path, filename, doc_id, user_id):
                 "chunk_text": chunk
             })
         
-        # Upload chunks to vector database
-        upload_chunks_to_qdrant(processed_chunks, user_id)
-        
         return processed_chunks
     except Exception as e:
         print(f"Detailed error processing image: {type(e).__name__}: {str(e)}")
@@ -100,10 +193,13 @@ def process_pdf(file_path, filename, doc_id, user_id):
             raise ValueError(f"PDF file is empty: {file_path}")
         
         # Try to open the PDF with more detailed error handling
+        pdf_path = file_path
         try:
             print(f"Opening PDF: {file_path}")
-            pdf_document = fitz.open(file_path)
-            print(f"PDF opened successfully. Pages: {len(pdf_document)}")
+            with _fitz_lock:
+                pdf_document = fitz.open(file_path)
+                n_pages = len(pdf_document)
+            print(f"PDF opened successfully. Pages: {n_pages}")
         except Exception as pdf_error:
             print(f"Error opening PDF with PyMuPDF: {type(pdf_error).__name__}: {str(pdf_error)}")
             
@@ -114,28 +210,42 @@ def process_pdf(file_path, filename, doc_id, user_id):
             if len(pdf_content) == 0:
                 raise ValueError(f"PDF file content is empty")
                 
-            # Create a temporary file with the content
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.write(pdf_content)
-            temp_pdf.close()
-            
-            try:
-                pdf_document = fitz.open(temp_pdf.name)
-                print(f"PDF opened successfully via temp file. Pages: {len(pdf_document)}")
-            except Exception as temp_pdf_error:
-                os.unlink(temp_pdf.name)
-                raise Exception(f"Failed to open PDF even with alternative method: {str(temp_pdf_error)}")
-        
-        # Extract text from each page
-        all_text = ""
-        for page_num in range(len(pdf_document)):
+            # Open the bytes in memory rather than round-tripping through a temp file
             try:
-                page = pdf_document[page_num]
-                page_text = page.get_text()
-                all_text += page_text
-                print(f"Extracted {len(page_text)} characters from page {page_num+1}")
-            except Exception as page_error:
-                print(f"Error extracting text from page {page_num+1}: {str(page_error)}")
+                with _fitz_lock:
+                    pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
+                    n_pages = len(pdf_document)
+                pdf_path = None  # No path for worker processes to reopen
+                print(f"PDF opened successfully from memory. Pages: {n_pages}")
+            except Exception as stream_error:
+                raise Exception(f"Failed to open PDF even with alternative method: {str(stream_error)}")
+        
+        # Extract text from each page (OCR'ing scanned ones); large PDFs are split across worker processes
+        if pdf_path and n_pages >= PDF_PARALLEL_MIN_PAGES:
+            with _fitz_lock:
+                pdf_document.close()
+            workers = min(os.cpu_count() or 1, PDF_MAX_WORKERS)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context) as pool:
+                # Workers are forked while the pages are submitted. Other ingest threads only
+                # touch MuPDF under _fitz_lock, so holding it here means no child can inherit
+                # a thread's half-finished MuPDF state (or a MuPDF-internal lock it held)
+                with _fitz_lock:
+                    results = pool.map(partial(_extract_page, pdf_path), range(n_pages))
+                page_texts = list(results)
+        else:
+            page_texts = []
+            for page_num in range(n_pages):
+                try:
+                    with _fitz_lock:
+                        page = pdf_document[page_num]
+                    page_texts.append(_page_text(page, _fitz_lock))
+                except Exception as page_error:
+                    print(f"Error extracting text from page {page_num+1}: {str(page_error)}")
+                    page_texts.append("")
+        if logger.isEnabledFor(logging.DEBUG):
+            for page_num, page_text in enumerate(page_texts):
+                logger.debug(f"Extracted {len(page_text)} characters from page {page_num+1}")
+        all_text = "".join(page_texts)
         
         # Check if we got any text
         if not all_text.strip():
@@ -157,13 +267,6 @@ def process_pdf(file_path, filename, doc_id, user_id):
                 "chunk_text": chunk
             })
         
-        # Upload chunks to vector database
-        upload_chunks_to_qdrant(processed_chunks, user_id)
-        
-        # Clean up any temporary files
-        if 'temp_pdf' in locals() and os.path.exists(temp_pdf.name):
-            os.unlink(temp_pdf.name)
-            
         return processed_chunks
     except Exception as e:
         print(f"Detailed PDF processing error: {type(e).__name__}: {str(e)}")
@@ -205,9 +308,6 @@ def process_text_file(file_path, filename, doc_id, user_id):
                 "chunk_text": chunk
             })
         
-        # Upload chunks to vector database
-        upload_chunks_to_qdrant(processed_chunks, user_id)
-        
         return processed_chunks
     except Exception as e:
         print(f"Error processing text file: {type(e).__name__}: {str(e)}")
@@ -259,25 +359,72 @@ def process_document(file_path, filename, doc_id, user_id):
 
 
 
+# Collections already known to exist, so uploads don't re-check the server every time
+_known_collections = set()
+
+def _is_not_found(error):
+    """Whether a Qdrant client error means the collection doesn't exist (gRPC, REST or local mode)"""
+    if isinstance(error, RpcError):
+        return callable(getattr(error, "code", None)) and error.code() == StatusCode.NOT_FOUND
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code == 404
+    return isinstance(error, ValueError)
+
 def create_user_collection(user_id):
     """Create a collection for a specific user if it doesn't exist"""
     collection_name = f"user_{user_id}_docs"
+    if collection_name in _known_collections:
+        return collection_name
     
-    if not client.collection_exists(collection_name=collection_name):
+    # Look the collection up directly (raises if it doesn't exist yet) rather than probing first
+    try:
+        client.get_collection(collection_name)
+    except (RpcError, UnexpectedResponse, ValueError) as lookup_error:
+        # Timeouts and dropped connections are not "missing"; let the caller see them
+        if not _is_not_found(lookup_error):
+            raise
         client.create_collection(
             collection_name=collection_name,
-            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE)
+            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+            # Score against int8 copies kept in RAM; the FP32 originals are only read to rescore
+            quantization_config=ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+            ),
+            # Don't build HNSW while the first upload streams in
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=0)
         )
+    # Searches can be restricted to chosen documents; index doc_id so Qdrant filters
+    # before the ANN search instead of checking payloads as it goes. Idempotent, so
+    # collections created before the index existed pick it up too
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="doc_id",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+    _known_collections.add(collection_name)
     
     return collection_name
 
+def get_embedding_model():
+    """Get the process-wide embedding model, loading it on the first call"""
+    global embedding_model
+    if embedding_model is None:
+        with _embedding_model_lock:
+            if embedding_model is None:
+                logger.debug("Initializing embedding model...")
+                model = TextEmbedding(model_name=EMBED_MODEL_NAME, threads=EMBED_THREADS)
+                # One forward pass now, so the first real batch doesn't pay for ONNX session setup
+                list(model.embed(["warmup"]))
+                embedding_model = model
+    return embedding_model
+
 def get_qdrant_client():
     """Get a Qdrant client instance"""
     try:
         # Use the global client that was initialized at the top of the file
         global client
         if client is None:
-            client = QdrantClient(host="localhost", port=6333)
+            client = QdrantClient(**QDRANT_CLIENT_KWARGS)
         return client
     except Exception as e:
         print(f"Error getting Qdrant client: {type(e).__name__}: {str(e)}")
@@ -289,95 +436,111 @@ def upload_chunks_to_qdrant(chunks, user_id):
     collection_name = f"user_{user_id}_docs"
     
     try:
-        print(f"Uploading {len(chunks)} chunks to Qdrant for user {user_id}")
-        print(f"Collection name: {collection_name}")
-        
-        # Debug Qdrant connection
-        try:
-            print("Testing Qdrant connection...")
-            collections = client.get_collections().collections
-            print(f"Available collections: {[c.name for c in collections]}")
-        except Exception as conn_error:
-            print(f"ERROR: Could not connect to Qdrant: {type(conn_error).__name__}: {str(conn_error)}")
-            raise
+        logger.debug(f"Uploading {len(chunks)} chunks to Qdrant for user {user_id}")
+        logger.debug(f"Collection name: {collection_name}")
         
         # Create collection if it doesn't exist
         try:
-            print(f"Creating collection {collection_name} if it doesn't exist")
+            logger.debug(f"Creating collection {collection_name} if it doesn't exist")
             create_user_collection(user_id)
-            print(f"Collection {collection_name} is ready")
+            logger.debug(f"Collection {collection_name} is ready")
         except Exception as coll_error:
-            print(f"ERROR: Could not create collection: {type(coll_error).__name__}: {str(coll_error)}")
+            logger.error(f"Could not create collection: {type(coll_error).__name__}: {str(coll_error)}")
             raise
         
-        # Initialize embedding model - use the global one that was already initialized
-        global embedding_model
+        # Get the shared embedding model (loaded on first use)
         try:
-            if embedding_model is None:
-                print("Initializing embedding model...")
-                embedding_model = TextEmbedding()
-            print("Embedding model is ready")
+            embedding_model = get_embedding_model()
+            logger.debug("Embedding model is ready")
         except Exception as emb_error:
-            print(f"ERROR: Could not initialize embedding model: {type(emb_error).__name__}: {str(emb_error)}")
+            logger.error(f"Could not initialize embedding model: {type(emb_error).__name__}: {str(emb_error)}")
             raise
         
-        # Prepare points for upload
-        points = []
-        for i, chunk in enumerate(chunks):
-            try:
-                # Generate embedding
-                print(f"Generating embedding for chunk {i+1}/{len(chunks)}")
-                chunk_text = chunk["chunk_text"]
-                if not chunk_text or len(chunk_text.strip()) == 0:
-                    print(f"Warning: Empty text in chunk {i+1}, skipping")
-                    continue
-                
-                print(f"Chunk {i+1} text sample: {chunk_text[:50]}...")
-                # Convert generator to list to avoid 'generator' has no len() error
-                embeddings = list(embedding_model.embed([chunk_text]))
-                
-                if embeddings is None or len(embeddings) == 0 or embeddings[0] is None:
-                    print(f"Warning: Failed to generate embedding for chunk {i+1}, skipping")
-                    continue
-                
-                # Create point with an integer ID (Qdrant requires either UUID or integer)
-                # Using a simple integer is more reliable than UUID strings
-                point = PointStruct(
-                    id=i,  # Use the loop counter as a simple integer ID
-                    vector=embeddings[0].tolist(),
-                    payload={
-                        "doc_id": chunk["doc_id"],
-                        "filename": chunk["filename"],
-                        "chunk_id": chunk["chunk_id"],
-                        "text": chunk_text,
-                        "original_id": f"{chunk['doc_id']}_{chunk['chunk_id']}"  # Store original ID in payload for reference
-                    }
-                )
-                points.append(point)
-                print(f"Created point for chunk {i+1} with ID {point.id}")
-            except Exception as chunk_error:
-                print(f"Error processing chunk {i+1}: {type(chunk_error).__name__}: {str(chunk_error)}")
-                # Continue with other chunks instead of failing completely
-                continue
+        # Skip chunks without text
+        text_chunks = [
+            chunk for chunk in chunks
+            if chunk["chunk_text"] and chunk["chunk_text"].strip()
+        ]
+        if len(text_chunks) < len(chunks):
+            logger.warning(f"Skipping {len(chunks) - len(text_chunks)} empty chunks")
         
-        if not points:
-            print("Warning: No valid points to upload to Qdrant")
+        if not text_chunks:
+            logger.warning("No valid points to upload to Qdrant")
             return 0
-            
-        print(f"Uploading {len(points)} points to Qdrant collection {collection_name}")
         
-        # Upload points to Qdrant
+        # Derive UUID point IDs from doc_id + chunk_id, so chunks of different documents
+        # never collide and retrying an upload of the same document rewrites the same points
+        keyed_chunks = [
+            (str(uuid.uuid5(uuid.NAMESPACE_OID, f"{chunk['doc_id']}_{chunk['chunk_id']}")), chunk)
+            for chunk in text_chunks
+        ]
+        
+        # Group chunks of similar length so each batch pads to a similar size
+        keyed_chunks.sort(key=lambda item: len(item[1]["chunk_text"]))
+        
+        # Embed all chunk texts in batches instead of one model call per chunk
         try:
-            client.upsert(
-                collection_name=collection_name,
-                points=points
-            )
-            print("Successfully uploaded points to Qdrant")
-            print(f"Upload complete! {len(points)} chunks added to collection.")
-            return len(points)
+            logger.debug(f"Generating embeddings for {len(keyed_chunks)} chunks")
+            texts = [chunk["chunk_text"] for _, chunk in keyed_chunks]
+            # Fill one contiguous float32 block as batches come out of the model, rather
+            # than keeping a list of per-chunk arrays and copying them all afterwards
+            vectors = np.empty((len(texts), VECTOR_SIZE), dtype=np.float32)
+            for row, embedding in enumerate(embedding_model.embed(texts, batch_size=EMBED_BATCH_SIZE)):
+                vectors[row] = embedding
+        except Exception as emb_error:
+            logger.error(f"Failed to generate embeddings: {type(emb_error).__name__}: {str(emb_error)}")
+            raise
+        
+        # IDs and payloads are generated lazily, one upload batch at a time
+        ids = (point_id for point_id, _ in keyed_chunks)
+        upload_ts = time.time()
+        payloads = (
+            {
+                "doc_id": chunk["doc_id"],
+                "user_id": user_id,
+                "upload_ts": upload_ts,
+                "filename": chunk["filename"],
+                "chunk_id": chunk["chunk_id"],
+                "text": chunk["chunk_text"],
+                "original_id": f"{chunk['doc_id']}_{chunk['chunk_id']}"  # Store original ID in payload for reference
+            }
+            for _, chunk in keyed_chunks
+        )
+        
+        num_points = len(keyed_chunks)
+        logger.debug(f"Uploading {num_points} points to Qdrant collection {collection_name}")
+        
+        try:
+            # The float32 block goes in as is: over gRPC the client packs each row
+            # straight into a protobuf point, with no per-float pydantic validation
+            try:
+                client.upload_collection(
+                    collection_name=collection_name,
+                    vectors=vectors,
+                    payload=payloads,
+                    ids=ids,
+                    batch_size=UPLOAD_BATCH_SIZE,
+                    # Don't block on each batch being applied server-side
+                    wait=False
+                )
+            finally:
+                # Index the collection once, now that the points are in. Also after a failed
+                # upload, or the collection would stay unindexed (threshold 0) for good
+                try:
+                    client.update_collection(
+                        collection_name=collection_name,
+                        optimizers_config=OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+                    )
+                except Exception as index_error:
+                    logger.error(f"Could not re-enable indexing: {type(index_error).__name__}: {str(index_error)}")
+            logger.debug("Successfully uploaded points to Qdrant")
+            logger.debug(f"Upload complete! {num_points} chunks added to collection.")
+            return num_points
         except Exception as upsert_error:
-            print(f"ERROR: Failed to upsert points to Qdrant: {type(upsert_error).__name__}: {str(upsert_error)}")
+            # The collection may have been dropped behind our back; check again next time
+            _known_collections.discard(collection_name)
+            logger.error(f"Failed to upload points to Qdrant: {type(upsert_error).__name__}: {str(upsert_error)}")
             raise
     except Exception as e:
-        print(f"Error in upload_chunks_to_qdrant: {type(e).__name__}: {str(e)}")
+        logger.error(f"Error in upload_chunks_to_qdrant: {type(e).__name__}: {str(e)}")
         raise Exception(f"Failed to upload chunks to vector database: {str(e)}")
@@ -10,7 +10,7 @@ Settings.embed_model = FastEmbedEmbedding(model_name="BAAI/bge-small-en-v1.5")
 Settings.llm = Ollama(model="llama3", request_timeout=120.0)
 
 # 2. Connect to Qdrant
-client = QdrantClient(host="localhost", port=6333)
+client = QdrantClient(host="localhost", grpc_port=6334, prefer_grpc=True)
 vector_store = QdrantVectorStore(client=client, collection_name="ocr_chunks")
 
 # 3. Build the LlamaIndex index from the vector store
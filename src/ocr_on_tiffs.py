@@ -2,16 +2,31 @@ import pytesseract
 from PIL import Image
 from pathlib import Path
 
+# tesserocr calls Tesseract through its C API; fall back to the pytesseract CLI wrapper
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
 # Adjust the path below if needed
 tiff_dir = Path("/Users/shivkpatel/Desktop/data/idl_data/extracted")
 tiff_files = list(tiff_dir.glob("*.tif"))
 
 if not tiff_files:
     print("No TIFF files found!")
+elif PyTessBaseAPI is not None:
+    # One engine for every file, so tessdata is only loaded once
+    with PyTessBaseAPI() as api:
+        for tiff_path in tiff_files[:5]:  # Process the first 5 TIFFs
+            api.SetImage(Image.open(tiff_path))
+            text = api.GetUTF8Text()
+            print(f"--- OCR from {tiff_path.name} ---")
+            print(text[:500])  # Print first 500 characters
+            print("\n" + "="*50 + "\n")
 else:
     for tiff_path in tiff_files[:5]:  # Process the first 5 TIFFs
-        img = Image.open(tiff_path)
-        text = pytesseract.image_to_string(img)
+        # Let tesseract read the file itself instead of decoding it into a PIL image first
+        text = pytesseract.image_to_string(str(tiff_path))
         print(f"--- OCR from {tiff_path.name} ---")
         print(text[:500])  # Print first 500 characters
         print("\n" + "="*50 + "\n")
@@ -3,84 +3,338 @@ import os
 import tempfile
 from pathlib import Path
 import uuid
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import numpy as np
+import pandas as pd
 
 # Import LlamaIndex components
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    VectorParams, Distance, PointStruct, Filter, FieldCondition, Range, MatchValue, FilterSelector,
+    SearchParams, QuantizationSearchParams
+)
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 from llama_index.core.indices.vector_store.base import VectorStoreIndex
 from llama_index.embeddings.fastembed import FastEmbedEmbedding
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.llms.ollama import Ollama
 from llama_index.core import Settings
+from llama_index.core.schema import QueryBundle
 
 # Import our custom modules
-from document_processor import process_document, upload_chunks_to_qdrant
-from chat_history import save_chat_message, get_chat_history, save_document_record, get_user_documents
+from document_processor import (
+    process_document, upload_chunks_to_qdrant, get_qdrant_client, get_embedding_model,
+    VECTOR_SIZE, EMBED_MODEL_NAME, EMBED_THREADS, QDRANT_CLIENT_KWARGS
+)
+from chat_history import save_chat_messages, get_chat_history, save_document_records, get_user_documents
 from aws_cognito import sign_up, sign_in, confirm_sign_up, local_auth_enabled
 
-# Set up LlamaIndex to use FastEmbed for embeddings and Llama 3 via Ollama for LLM
-Settings.embed_model = FastEmbedEmbedding(model_name="BAAI/bge-small-en-v1.5")
-Settings.llm = Ollama(model="llama3", request_timeout=120.0)
+# LlamaIndex uses FastEmbed for embeddings and Llama 3 via Ollama for the LLM. They are
+# set up on the first chat turn rather than at import, so Gradio starts serving sooner
+_settings_ready = False
+_settings_lock = threading.Lock()
 
-# Connect to Qdrant
-client = QdrantClient(host="localhost", port=6333)
+class SharedFastEmbedEmbedding(FastEmbedEmbedding):
+    """FastEmbedEmbedding over ingestion's TextEmbedding, so the process loads bge-small once"""
+    
+    def __init__(self, model):
+        # FastEmbedEmbedding.__init__ would load a second ONNX session; set the fields and reuse ours
+        BaseEmbedding.__init__(self, model_name=EMBED_MODEL_NAME, threads=EMBED_THREADS)
+        self._model = model
+
+def _ensure_settings():
+    """Configure LlamaIndex's embedding model and LLM, once"""
+    global _settings_ready
+    if _settings_ready:
+        return
+    with _settings_lock:
+        if not _settings_ready:
+            Settings.embed_model = SharedFastEmbedEmbedding(get_embedding_model())
+            Settings.llm = Ollama(model="llama3", request_timeout=120.0)
+            _settings_ready = True
+
+# Share ingestion's Qdrant client instead of opening a second connection; the chat path
+# awaits the async client (same settings) so it never blocks the event loop
+client = get_qdrant_client()
+aclient = AsyncQdrantClient(**QDRANT_CLIENT_KWARGS)
 
 # Global variables
 UPLOAD_FOLDER = Path("./uploads")
 UPLOAD_FOLDER.mkdir(exist_ok=True)
-current_user_id = None  # Will be set after login
+# The logged-in user's id lives in each browser session's gr.State and is passed to
+# every handler; this only records who is logged in
 user_sessions = {}  # Store active user sessions
 
-def get_user_collection(user_id):
-    """Get or create a collection for a specific user"""
-    collection_name = f"user_{user_id}_docs"
-    
-    if not client.collection_exists(collection_name=collection_name):
-        # If no documents have been uploaded yet, use the default collection
-        if client.collection_exists(collection_name="ocr_chunks"):
-            return "ocr_chunks"
-        else:
+# Semantic response cache
+QCACHE_SCORE_THRESHOLD = 0.95  # Cosine similarity for two questions to count as the same
+QCACHE_TTL_SECONDS = 3600  # How long a cached answer stays valid
+QCACHE_PURGE_INTERVAL = 600  # Minimum seconds between deletes of expired entries
+
+# Exact-match response cache
+EXACT_CACHE_MAXSIZE = 1024  # Oldest entries are evicted first
+EXACT_CACHE_TTL_SECONDS = 3600
+
+QUERY_ENGINE_CACHE_SIZE = 128  # Engines kept across users and document selections
+
+INGEST_WORKERS = 4  # Uploaded files parsed/OCR'd at once, across all sessions
+DOCS_CACHE_TTL_SECONDS = 5  # How long a user's document list is reused across UI refreshes
+
+@lru_cache(maxsize=1024)
+def _embed_normalized_query(query):
+    return tuple(Settings.embed_model.get_query_embedding(query))
+
+def get_query_embedding(query):
+    """Embed a chat question, reusing the vector when the same question comes back"""
+    # bge-small-en lowercases and strips its input anyway, so this normalisation
+    # only widens cache hits; it never changes the vector
+    _ensure_settings()
+    return list(_embed_normalized_query(query.strip().lower()))
+
+def _doc_scope(doc_ids):
+    """Canonical, hashable form of the documents a question is restricted to (() = all)"""
+    return tuple(sorted(doc_ids)) if doc_ids else ()
+
+# User collections are int8-quantized: fetch twice the candidates from the quantized
+# vectors, then rescore them against the originals so ranking stays FP32-accurate.
+# Only a handful of chunks are returned, so a narrower HNSW beam than the default suffices
+QUANTIZED_SEARCH_PARAMS = SearchParams(
+    hnsw_ef=64,
+    quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+
+# Payload fields a retrieved chunk needs: its text, plus what identifies it. The rest
+# (user_id, upload_ts, original_id) would only be copied into the node's metadata and
+# from there into the LLM prompt
+RETRIEVAL_PAYLOAD_FIELDS = ["text", "doc_id", "filename", "chunk_id"]
+
+class QuantizedQdrantVectorStore(QdrantVectorStore):
+    """QdrantVectorStore that passes QUANTIZED_SEARCH_PARAMS to dense searches and fetches only RETRIEVAL_PAYLOAD_FIELDS"""
+    
+    def query(self, query, **kwargs):
+        response = self._client.query_points(
+            collection_name=self.collection_name,
+            query=query.query_embedding,
+            limit=query.similarity_top_k,
+            query_filter=kwargs.get("qdrant_filters") or self._build_query_filter(query),
+            search_params=QUANTIZED_SEARCH_PARAMS,
+            with_payload=RETRIEVAL_PAYLOAD_FIELDS,
+            with_vectors=False
+        )
+        return self.parse_to_query_result(response.points)
+    
+    async def aquery(self, query, **kwargs):
+        response = await self._aclient.query_points(
+            collection_name=self.collection_name,
+            query=query.query_embedding,
+            limit=query.similarity_top_k,
+            query_filter=kwargs.get("qdrant_filters") or self._build_query_filter(query),
+            search_params=QUANTIZED_SEARCH_PARAMS,
+            with_payload=RETRIEVAL_PAYLOAD_FIELDS,
+            with_vectors=False
+        )
+        return self.parse_to_query_result(response.points)
+
+# Vector stores by user_id. A store only holds the clients and the collection name, so
+# it stays valid across uploads and is kept for the life of the process
+_vector_stores = {}
+
+# Query engines by (user_id, doc scope), built once and reused across chat turns. Every
+# document selection gets its own engine, so keep only the most recently used ones
+_query_engines = OrderedDict()
+_query_engines_lock = threading.Lock()  # Upload handlers invalidate from worker threads
+
+def get_vector_store(user_id):
+    """Get the vector store over a user's collection (blocking: the first call checks the collection over RPC)"""
+    vector_store = _vector_stores.get(user_id)
+    if vector_store is None:
+        vector_store = QuantizedQdrantVectorStore(
+            client=client,
+            aclient=aclient,  # Used by aretrieve
+            collection_name=f"user_{user_id}_docs"
+        )
+        # Built on worker threads; if two raced, keep whichever was stored first
+        vector_store = _vector_stores.setdefault(user_id, vector_store)
+    return vector_store
+
+async def get_query_engine(user_id, doc_scope=()):
+    """Get a query engine for a specific user, optionally searching only some documents"""
+    # The first call loads the embedding model; keep that off the event loop
+    await asyncio.to_thread(_ensure_settings)
+    key = (user_id, doc_scope)
+    with _query_engines_lock:
+        query_engine = _query_engines.get(key)
+        if query_engine is not None:
+            _query_engines.move_to_end(key)
+    if query_engine is None:
+        query_engine = await _build_query_engine(user_id, doc_scope)
+        # Don't cache misses, so the engine is built as soon as documents arrive
+        if query_engine is not None:
+            with _query_engines_lock:
+                _query_engines[key] = query_engine
+                if len(_query_engines) > QUERY_ENGINE_CACHE_SIZE:
+                    _query_engines.popitem(last=False)
+    return query_engine
+
+def invalidate_query_engine(user_id):
+    """Drop a user's cached query engines so the next chat turn rebuilds them (the store is kept)"""
+    with _query_engines_lock:
+        for key in [key for key in _query_engines if key[0] == user_id]:
+            del _query_engines[key]
+
+# (user_id, doc scope, digest of normalized question) -> (response_text, time cached)
+_exact_cache = {}
+_exact_cache_lock = threading.Lock()
+
+def _exact_cache_key(user_id, doc_scope, message):
+    return (user_id, doc_scope, hashlib.blake2b(message.strip().lower().encode(), digest_size=16).digest())
+
+def get_exact_cached_response(user_id, doc_scope, message):
+    """Return the answer to the same question asked recently, or None"""
+    key = _exact_cache_key(user_id, doc_scope, message)
+    with _exact_cache_lock:
+        entry = _exact_cache.get(key)
+        if entry is None:
             return None
-    
-    return collection_name
+        response_text, cached_at = entry
+        if time.monotonic() - cached_at > EXACT_CACHE_TTL_SECONDS:
+            del _exact_cache[key]
+            return None
+        return response_text
+
+def exact_cache_response(user_id, doc_scope, message, response_text):
+    """Remember the answer to a question, evicting the oldest entry when full"""
+    key = _exact_cache_key(user_id, doc_scope, message)
+    with _exact_cache_lock:
+        _exact_cache.pop(key, None)
+        if len(_exact_cache) >= EXACT_CACHE_MAXSIZE:
+            # Dicts keep insertion order, so the first key is the oldest
+            del _exact_cache[next(iter(_exact_cache))]
+        _exact_cache[key] = (response_text, time.monotonic())
+
+def clear_exact_cache(user_id):
+    """Forget every exact-match answer cached for a user"""
+    with _exact_cache_lock:
+        for key in [key for key in _exact_cache if key[0] == user_id]:
+            del _exact_cache[key]
 
-def get_query_engine(user_id):
-    """Get a query engine for a specific user"""
+def _qcache_collection(user_id):
+    return f"user_{user_id}_qcache"
+
+_qcache_collections = set()  # Cache collections known to exist
+_qcache_last_purge = {}  # user_id -> time expired entries were last deleted
+
+async def get_cached_response(user_id, doc_scope, query_embedding):
+    """Return the cached answer to a near-identical recent question, or None"""
     try:
-        print(f"Getting query engine for user {user_id}")
+        response = await aclient.query_points(
+            collection_name=_qcache_collection(user_id),
+            query=query_embedding,
+            query_filter=Filter(must=[
+                FieldCondition(key="created_at", range=Range(gte=time.time() - QCACHE_TTL_SECONDS)),
+                # Only reuse answers drawn from the same set of documents
+                FieldCondition(key="doc_scope", match=MatchValue(value=",".join(doc_scope)))
+            ]),
+            limit=1,
+            score_threshold=QCACHE_SCORE_THRESHOLD,
+            with_payload=["response"]
+        )
+    except Exception:
+        # No cache collection yet (or Qdrant is unhappy) - just answer normally
+        return None
+    hits = response.points
+    return hits[0].payload["response"] if hits else None
+
+async def cache_response(user_id, doc_scope, query_embedding, query, response_text):
+    """Store an answer keyed by its question's embedding"""
+    collection_name = _qcache_collection(user_id)
+    try:
+        if collection_name not in _qcache_collections:
+            if not await aclient.collection_exists(collection_name=collection_name):
+                await aclient.create_collection(
+                    collection_name=collection_name,
+                    vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE)
+                )
+            _qcache_collections.add(collection_name)
+        
+        now = time.time()
+        await aclient.upsert(
+            collection_name=collection_name,
+            points=[PointStruct(
+                id=str(uuid.uuid4()),
+                vector=query_embedding,
+                payload={
+                    "query": query,
+                    "response": response_text,
+                    "doc_scope": ",".join(doc_scope),
+                    "created_at": now
+                }
+            )],
+            wait=False
+        )
+        
+        # Expired entries are already filtered out of lookups; delete them now and then
+        if now - _qcache_last_purge.get(user_id, 0) >= QCACHE_PURGE_INTERVAL:
+            _qcache_last_purge[user_id] = now
+            await aclient.delete(
+                collection_name=collection_name,
+                points_selector=FilterSelector(filter=Filter(must=[
+                    FieldCondition(key="created_at", range=Range(lt=now - QCACHE_TTL_SECONDS))
+                ])),
+                wait=False
+            )
+    except Exception as e:
+        print(f"Error caching response: {type(e).__name__}: {str(e)}")
+
+def clear_response_cache(user_id):
+    """Forget a user's cached answers, e.g. after their documents change"""
+    collection_name = _qcache_collection(user_id)
+    _qcache_collections.discard(collection_name)
+    try:
+        client.delete_collection(collection_name=collection_name)
+    except Exception as e:
+        print(f"Error clearing response cache: {type(e).__name__}: {str(e)}")
+
+async def _build_query_engine(user_id, doc_scope=()):
+    """Build a query engine over a user's collection, filtered to doc_scope when it is set"""
+    try:
+        print(f"Building query engine for user {user_id}")
         
         # Get collection name for this user
         collection_name = f"user_{user_id}_docs"
         print(f"Looking for collection: {collection_name}")
         
-        # Check if collection exists
+        # Check the collection has points (raises if it doesn't exist yet)
         try:
-            collections = client.get_collections().collections
-            collection_names = [c.name for c in collections]
-            
-            if collection_name not in collection_names:
-                print(f"Collection {collection_name} does not exist")
-                return None
-                
-            # Check if collection has points
-            collection_info = client.get_collection(collection_name)
+            collection_info = await aclient.get_collection(collection_name)
             if collection_info.points_count == 0:
                 print(f"Collection {collection_name} exists but is empty")
                 return None
                 
             print(f"Found collection {collection_name} with {collection_info.points_count} points")
         except Exception as coll_error:
-            print(f"Error checking collection: {type(coll_error).__name__}: {str(coll_error)}")
+            print(f"Collection {collection_name} is not available: {type(coll_error).__name__}: {str(coll_error)}")
             return None
         
-        # Create vector store
+        # The store's constructor makes a blocking RPC, so assemble the engine on a worker thread
+        return await asyncio.to_thread(_assemble_query_engine, user_id, doc_scope)
+    except Exception as e:
+        print(f"Unexpected error in _build_query_engine: {type(e).__name__}: {str(e)}")
+        return None
+
+def _assemble_query_engine(user_id, doc_scope):
+    """Build the vector store index and query engine over a user's collection (blocking)"""
+    try:
+        # Get the user's vector store (created on their first chat turn)
         try:
-            print("Creating vector store...")
-            vector_store = QdrantVectorStore(
-                client=client,
-                collection_name=collection_name
-            )
-            print("Vector store created successfully")
+            vector_store = get_vector_store(user_id)
         except Exception as vs_error:
             print(f"Error creating vector store: {type(vs_error).__name__}: {str(vs_error)}")
             return None
@@ -99,7 +353,10 @@ def get_query_engine(user_id):
             print("Creating query engine...")
             query_engine = index.as_query_engine(
                 llm=Settings.llm,
-                similarity_top_k=3
+                similarity_top_k=3,
+                streaming=True,  # Answers come back as a token generator
+                # Qdrant pre-filters on the indexed doc_id payload field before the ANN search
+                doc_ids=list(doc_scope) or None
             )
             print("Query engine created successfully")
             return query_engine
@@ -107,47 +364,83 @@ def get_query_engine(user_id):
             print(f"Error creating query engine: {type(qe_error).__name__}: {str(qe_error)}")
             return None
     except Exception as e:
-        print(f"Unexpected error in get_query_engine: {type(e).__name__}: {str(e)}")
+        print(f"Unexpected error in _assemble_query_engine: {type(e).__name__}: {str(e)}")
         return None
 
-def process_uploaded_file(files):
+# Long-lived so each thread keeps its Tesseract engine (see document_processor.ocr_image)
+# instead of reloading tessdata on every upload
+_ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+
+def _extract_file(file, user_id):
+    """Parse or OCR one uploaded file; returns (document record or None, chunks, status line)"""
+    try:
+        # Gradio provides the file path directly - no need to create temp file
+        file_path = file.name
+        file_name = os.path.basename(file_path)
+        
+        # Process the document directly from the Gradio temp file
+        doc_id = str(uuid.uuid4())
+        chunks = process_document(file_path, file_name, doc_id, user_id)
+        
+        if not chunks or len(chunks) == 0:
+            return None, [], f"⚠️ {file_name}: No text could be extracted"
+        
+        return {"doc_id": doc_id, "filename": file_name}, chunks, f"✅ {file_name}: {len(chunks)} chunks extracted"
+    except Exception as e:
+        return None, [], f"❌ {file.name if hasattr(file, 'name') else 'Unknown file'}: Error - {str(e)}"
+
+@lru_cache(maxsize=64)
+def _user_docs_cached(user_id, bucket):
+    """get_user_documents, memoized per DOCS_CACHE_TTL_SECONDS time bucket"""
+    return get_user_documents(user_id)
+
+def user_documents(user_id):
+    """The user's document records, re-read from storage at most every DOCS_CACHE_TTL_SECONDS"""
+    return _user_docs_cached(user_id, int(time.time() // DOCS_CACHE_TTL_SECONDS))
+
+def process_uploaded_file(user_id, files):
     """Process and upload one or more documents"""
-    global current_user_id
-    
     if files is None or len(files) == 0:
         return "No files uploaded"
     
-    if not current_user_id:
+    if not user_id:
         return "You must be logged in to upload documents"
     
     results = []
     total_chunks = 0
+    ingested = []  # Document records to save once all files are processed
+    all_chunks = []  # Chunks from every file, embedded and uploaded together
+    
+    # Parse files concurrently: OCR runs in tesseract and reads wait on disk, so threads
+    # overlap well. map() keeps the status lines in upload order
+    for record, chunks, status in _ingest_executor.map(lambda file: _extract_file(file, user_id), files):
+        results.append(status)
+        if record is not None:
+            ingested.append(record)
+            all_chunks.extend(chunks)
+            total_chunks += len(chunks)
     
-    for file in files:
+    # Embed and upload every file's chunks in one pass
+    if all_chunks:
         try:
-            # Gradio provides the file path directly - no need to create temp file
-            file_path = file.name
-            file_name = os.path.basename(file_path)
-            
-            # Process the document directly from the Gradio temp file
-            doc_id = str(uuid.uuid4())
-            chunks = process_document(file_path, file_name, doc_id, current_user_id)
-            
-            if not chunks or len(chunks) == 0:
-                results.append(f"⚠️ {file_name}: No text could be extracted")
-                continue
-            
-            # Upload chunks to Qdrant
-            upload_chunks_to_qdrant(chunks, current_user_id)
-            
-            # Save document record
-            save_document_record(current_user_id, doc_id, file_name)
-            
-            total_chunks += len(chunks)
-            results.append(f"✅ {file_name}: {len(chunks)} chunks extracted")
-            
+            upload_chunks_to_qdrant(all_chunks, user_id)
         except Exception as e:
-            results.append(f"❌ {file.name if hasattr(file, 'name') else 'Unknown file'}: Error - {str(e)}")
+            summary = f"Extracted {total_chunks} chunks from {len(ingested)} document(s), but none could be stored."
+            return summary + "\n\n" + "\n".join(results + [f"❌ Upload to vector database failed: {str(e)}"])
+    
+    # New chunks are in the collection; rebuild the engine and stop serving old answers
+    if ingested:
+        invalidate_query_engine(user_id)
+        clear_exact_cache(user_id)
+        clear_response_cache(user_id)
+    
+    # Save all document records in one round trip
+    try:
+        save_document_records(user_id, ingested)
+    except Exception as e:
+        results.append(f"❌ Could not save document records: {str(e)}")
+    # The document list refreshes right after an upload; make sure it sees the new records
+    _user_docs_cached.cache_clear()
     
     summary = f"Processed {len(files)} document(s) with {total_chunks} total chunks extracted."
     return summary + "\n\n" + "\n".join(results)
@@ -161,68 +454,110 @@ def display_user_message(message, history):
     updated_history = history + [(message, "")]
     return updated_history, ""
 
-def get_ai_response(history):
-    """Generate AI response for the last user message"""
+# Chat history writes still in flight; holding them stops the tasks being garbage collected
+_history_writes = set()
+
+def _history_write_done(task):
+    _history_writes.discard(task)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        print(f"Error saving chat history: {str(error)}")
+    else:
+        print("Chat history saved successfully")
+
+async def get_ai_response(user_id, history, doc_ids=None):
+    """Generate AI response for the last user message, searching only doc_ids when given"""
     if not history:
-        return history
+        yield history
+        return
     
     # Get the last message (should be user message with empty response)
     user_message, current_response = history[-1]
     
     # If there's already a response, don't regenerate
     if current_response and current_response.strip():
-        return history
+        yield history
+        return
     
     try:
         print(f"Processing chat message: {user_message}")
+        doc_scope = _doc_scope(doc_ids)
         
-        # Get query engine
-        query_engine = get_query_engine(current_user_id)
-        if not query_engine:
-            print("No query engine available - user needs to upload documents first")
-            history[-1] = (user_message, "Please upload a document first. Go to the 'Upload Documents' tab to add a document.")
-            return history
-        
-        # Query the documents
-        try:
-            print("Querying documents...")
-            response = query_engine.query(user_message)
-            response_text = str(response)
-            print(f"Got response: {response_text[:100]}...")
-        except Exception as query_error:
-            print(f"Error querying documents: {type(query_error).__name__}: {str(query_error)}")
-            history[-1] = (user_message, f"Error processing your query: {str(query_error)}")
-            return history
-        
-        # Save chat history
-        try:
-            save_chat_message(current_user_id, "user", user_message, datetime.now().isoformat())
-            save_chat_message(current_user_id, "assistant", response_text, datetime.now().isoformat())
-            print("Chat history saved successfully")
-        except Exception as history_error:
-            print(f"Error saving chat history: {str(history_error)}")
+        # Exact repeats skip the whole pipeline
+        response_text = get_exact_cached_response(user_id, doc_scope, user_message)
+        if response_text is not None:
+            print("Answered from the exact-match cache")
+        else:
+            # Get query engine
+            query_engine = await get_query_engine(user_id, doc_scope)
+            if not query_engine:
+                print("No query engine available - user needs to upload documents first")
+                history[-1] = (user_message, "Please upload a document first. Go to the 'Upload Documents' tab to add a document.")
+                yield history
+                return
+            
+            # Query the documents, unless a near-identical question was answered recently
+            try:
+                # FastEmbed inference is CPU-bound, so keep it off the event loop
+                query_embedding = await asyncio.to_thread(get_query_embedding, user_message)
+                response_text = await get_cached_response(user_id, doc_scope, query_embedding)
+                if response_text is not None:
+                    print("Answered from the response cache")
+                else:
+                    print("Querying documents...")
+                    # Hand the embedding over so the retriever doesn't compute it again
+                    query_bundle = QueryBundle(user_message, embedding=query_embedding)
+                    nodes = await query_engine.aretrieve(query_bundle)
+                    # The Ollama client's async methods just call the blocking ones, so run
+                    # generation in a worker thread and pull tokens from it one at a time
+                    response = await asyncio.to_thread(query_engine.synthesize, query_bundle, nodes)
+                    response_text = ""
+                    while (token := await asyncio.to_thread(next, response.response_gen, None)) is not None:
+                        response_text += token
+                        history[-1] = (user_message, response_text)
+                        yield history
+                    print(f"Got response: {response_text[:100]}...")
+                    await cache_response(user_id, doc_scope, query_embedding, user_message, response_text)
+                exact_cache_response(user_id, doc_scope, user_message, response_text)
+            except Exception as query_error:
+                print(f"Error querying documents: {type(query_error).__name__}: {str(query_error)}")
+                history[-1] = (user_message, f"Error processing your query: {str(query_error)}")
+                yield history
+                return
         
         # Update the response
         history[-1] = (user_message, response_text)
-        return history
+        yield history
+        
+        # Save the exchange in one write, in the background so the handler finishes now
+        messages = [
+            {"role": "user", "content": user_message, "timestamp": datetime.now().isoformat()},
+            {"role": "assistant", "content": response_text, "timestamp": datetime.now().isoformat()}
+        ]
+        task = asyncio.create_task(asyncio.to_thread(save_chat_messages, user_id, messages))
+        _history_writes.add(task)
+        task.add_done_callback(_history_write_done)
         
     except Exception as e:
         print(f"Unexpected error in get_ai_response: {type(e).__name__}: {str(e)}")
         history[-1] = (user_message, f"An error occurred while processing your message: {str(e)}")
-        return history
+        yield history
 
-def chat_with_documents(message, history):
+async def chat_with_documents(user_id, message, history, doc_ids=None):
     """Chat with documents using RAG"""
     try:
         new_history, _ = display_user_message(message, history)
-        return get_ai_response(new_history)
+        async for updated_history in get_ai_response(user_id, new_history, doc_ids):
+            yield updated_history
     except Exception as e:
         print(f"Unexpected error in chat_with_documents: {type(e).__name__}: {str(e)}")
-        return [(message, f"An error occurred while processing your message: {str(e)}")]
+        yield [(message, f"An error occurred while processing your message: {str(e)}")]
 
-def list_documents():
+def list_documents(user_id):
     """List the user's documents as markdown"""
-    documents = get_user_documents(current_user_id)
+    documents = user_documents(user_id)
     if not documents:
         return "No documents found"
     
@@ -233,49 +568,45 @@ def list_documents():
     
     return "\n".join(formatted)
 
-def list_documents_as_dataframe():
-    """List the user's documents as a dataframe"""
-    documents = get_user_documents(current_user_id)
-    if not documents:
-        return [["No documents found", "", ""]]
-    
-    rows = []
-    for doc in documents:
-        time = datetime.fromisoformat(doc["upload_timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
-        rows.append([doc["doc_id"], doc["filename"], time])
-    
-    return rows
+def list_document_choices(user_id):
+    """The user's documents as (filename, doc_id) choices for the chat document filter"""
+    documents = user_documents(user_id)
+    return gr.update(choices=[(doc["filename"], doc["doc_id"]) for doc in documents])
+
+def _format_timestamps(column):
+    """Reformat a column of ISO timestamps for display, in one vectorized pass"""
+    # isoformat() drops the fraction when microseconds are 0, so parse as mixed ISO 8601
+    return pd.to_datetime(column, format="ISO8601").dt.strftime("%Y-%m-%d %H:%M:%S")
 
-def get_document_history_as_dataframe():
-    """Get document history as a dataframe"""
-    documents = get_user_documents(current_user_id)
+def _render_docs(user_id):
+    """Dataframe rows for the user's documents"""
+    documents = user_documents(user_id)
     if not documents:
         return [["No documents found", "", ""]]
     
-    rows = []
-    for doc in documents:
-        time = datetime.fromisoformat(doc["upload_timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
-        rows.append([doc["doc_id"], doc["filename"], time])
-    
-    return rows
+    df = pd.DataFrame(documents)
+    df["time"] = _format_timestamps(df["upload_timestamp"])
+    return df[["doc_id", "filename", "time"]].values.tolist()
+
+def list_documents_as_dataframe(user_id):
+    """List the user's documents as a dataframe, for the library and document history tables"""
+    return _render_docs(user_id)
 
-def get_chat_history_as_dataframe():
+def get_chat_history_as_dataframe(user_id):
     """Get chat history as a dataframe"""
-    history = get_chat_history(current_user_id)
+    history = get_chat_history(user_id)
     if not history:
         return [["No chat history", "", ""]]
     
-    rows = []
-    for msg in history:
-        time = datetime.fromisoformat(msg["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
-        role = "You" if msg.get("role", msg.get("message_type")) == "user" else "Assistant"
-        rows.append([time, role, msg["content"]])
-    
-    return rows
+    df = pd.DataFrame(history)
+    df["time"] = _format_timestamps(df["timestamp"])
+    role = df["role"] if "role" in df else df["message_type"]
+    df["speaker"] = np.where(role == "user", "You", "Assistant")
+    return df[["time", "speaker", "content"]].values.tolist()
 
-def show_chat_history():
+def show_chat_history(user_id):
     """Format chat history for display"""
-    history = get_chat_history(current_user_id)
+    history = get_chat_history(user_id)
     formatted = []
     
     for msg in history:
@@ -287,24 +618,22 @@ def show_chat_history():
 
 # Authentication functions
 def login(username, password):
-    """Log in a user with AWS Cognito or local authentication"""
-    global current_user_id
-    
+    """Log in a user with AWS Cognito or local authentication; the user id goes into the session state"""
     if not username or not password:
-        return "Please enter both username and password", None, gr.update(visible=True), gr.update(visible=False), gr.update(visible=True)
+        return "Please enter both username and password", None, gr.update(visible=True), gr.update(visible=False), gr.update(visible=True), None
     
     result = sign_in(username, password)
     
     if result["success"]:
-        current_user_id = result["user_id"]
-        user_sessions[current_user_id] = {
+        user_id = result["user_id"]
+        user_sessions[user_id] = {
             "username": username,
             "logged_in": True,
             "tokens": result.get("tokens", {})
         }
-        return f"Welcome, {username}!", None, gr.update(visible=False), gr.update(visible=True), gr.update(visible=True)
+        return f"Welcome, {username}!", None, gr.update(visible=False), gr.update(visible=True), gr.update(visible=True), user_id
     else:
-        return f"Login failed: {result['message']}", None, gr.update(visible=True), gr.update(visible=False), gr.update(visible=True)
+        return f"Login failed: {result['message']}", None, gr.update(visible=True), gr.update(visible=False), gr.update(visible=True), None
 
 def register(username, password, email):
     """Register a new user with AWS Cognito or local authentication"""
@@ -330,19 +659,16 @@ def confirm_registration(username, confirmation_code):
     else:
         return f"Confirmation failed: {result['message']}", gr.update(visible=True)
 
-def logout():
-    """Log out the current user"""
-    global current_user_id
+def logout(user_id):
+    """Log out the session's user and clear its state"""
+    if user_id and user_id in user_sessions:
+        del user_sessions[user_id]
     
-    if current_user_id and current_user_id in user_sessions:
-        del user_sessions[current_user_id]
-    
-    current_user_id = None
-    return "You have been logged out.", None, gr.update(visible=True), gr.update(visible=False)
+    return "You have been logged out.", None, gr.update(visible=True), gr.update(visible=False), None
 
-def check_login():
+def check_login(user_id):
     """Check if user is logged in and return appropriate visibility flags"""
-    if current_user_id and current_user_id in user_sessions and user_sessions[current_user_id]["logged_in"]:
+    if user_id and user_id in user_sessions and user_sessions[user_id]["logged_in"]:
         return gr.update(visible=False), gr.update(visible=True)
     else:
         return gr.update(visible=True), gr.update(visible=False)
@@ -380,6 +706,9 @@ with gr.Blocks(title="RAG Chatbot", theme=gr.themes.Soft(primary_hue="blue")) as
                         confirm_button = gr.Button("Confirm Registration", variant="primary", elem_id="confirm-button")
                         confirm_message = gr.Textbox(label="Status", interactive=False, visible=False, elem_id="confirm-message")
     
+    # Logged-in user's id, per browser session
+    user_state = gr.State(None)
+    
     # Main Application UI (hidden until login)
     with gr.Group(visible=False, elem_id="app-container") as app_group:
         with gr.Row(elem_id="header-row"):
@@ -417,6 +746,12 @@ with gr.Blocks(title="RAG Chatbot", theme=gr.themes.Soft(primary_hue="blue")) as
                 with gr.Column():
                     gr.Markdown("### Ask questions about your uploaded documents")
                     chatbot = gr.Chatbot(height=500, elem_id="chatbot")
+                    doc_filter = gr.Dropdown(
+                        label="Search only these documents (leave empty to search all)",
+                        choices=[],
+                        multiselect=True,
+                        elem_id="doc-filter"
+                    )
                     with gr.Row():
                         msg = gr.Textbox(
                             label="Your Question", 
@@ -457,7 +792,15 @@ with gr.Blocks(title="RAG Chatbot", theme=gr.themes.Soft(primary_hue="blue")) as
     login_button.click(
         login,
         inputs=[username_login, password_login],
-        outputs=[login_message, password_login, login_group, app_group, login_message]
+        outputs=[login_message, password_login, login_group, app_group, login_message, user_state]
+    ).then(
+        list_documents_as_dataframe,
+        inputs=[user_state],
+        outputs=[documents_list]
+    ).then(
+        list_document_choices,
+        inputs=[user_state],
+        outputs=[doc_filter]
     )
     
     register_button.click(
@@ -474,25 +817,33 @@ with gr.Blocks(title="RAG Chatbot", theme=gr.themes.Soft(primary_hue="blue")) as
     
     logout_button.click(
         logout,
-        inputs=[],
-        outputs=[login_message, password_login, login_group, app_group]
+        inputs=[user_state],
+        outputs=[login_message, password_login, login_group, app_group, user_state]
     )
     
     # Set up event handlers for the main application
     upload_button.click(
         process_uploaded_file,
-        inputs=[file_upload],
+        inputs=[user_state, file_upload],
         outputs=[upload_status]
     ).then(
         list_documents_as_dataframe,
-        inputs=[],
+        inputs=[user_state],
         outputs=[documents_list]
+    ).then(
+        list_document_choices,
+        inputs=[user_state],
+        outputs=[doc_filter]
     )
     
     refresh_docs_button.click(
         list_documents_as_dataframe,
-        inputs=[],
+        inputs=[user_state],
         outputs=[documents_list]
+    ).then(
+        list_document_choices,
+        inputs=[user_state],
+        outputs=[doc_filter]
     )
     
     msg.submit(
@@ -501,7 +852,7 @@ with gr.Blocks(title="RAG Chatbot", theme=gr.themes.Soft(primary_hue="blue")) as
         outputs=[chatbot, msg]
     ).then(
         get_ai_response,
-        inputs=[chatbot],
+        inputs=[user_state, chatbot, doc_filter],
         outputs=[chatbot]
     )
     
@@ -513,32 +864,21 @@ with gr.Blocks(title="RAG Chatbot", theme=gr.themes.Soft(primary_hue="blue")) as
     
     refresh_history_button.click(
         get_chat_history_as_dataframe,
-        inputs=[],
+        inputs=[user_state],
         outputs=[chat_history_list]
     )
     
     refresh_doc_history_button.click(
-        get_document_history_as_dataframe,
-        inputs=[],
-        outputs=[doc_history_list]
-    )
-    
-    # Auto-refresh document and chat history when app loads
-    demo.load(
         list_documents_as_dataframe,
-        inputs=None,
-        outputs=[documents_list]
+        inputs=[user_state],
+        outputs=[doc_history_list]
     )
 
 if __name__ == "__main__":
-    # If using local auth, set a default user for testing
+    # LOG_LEVEL=DEBUG shows per-upload ingestion progress
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
+    
     if local_auth_enabled():
-        print("Using local authentication with default user")
-        current_user_id = "default_user"
-        user_sessions[current_user_id] = {
-            "username": "default_user",
-            "logged_in": True,
-            "tokens": {}
-        }
+        print("Using local authentication")
     
     demo.launch(share=True)